@@ -13,11 +13,12 @@ import os
 import json
 import base64
 import hashlib
-import secrets
+import mmap
 from datetime import datetime, timezone
 import sys
 import shutil
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
 
 # Crypto
@@ -34,6 +35,43 @@ try:
 except Exception:
     Picamera2 = None
 
+# Optional SHA-NI accelerated SHA-256 (falls back to hashlib/OpenSSL)
+try:
+    from isal_crypto import SHA256 as _isal_sha256
+except Exception:
+    _isal_sha256 = None
+
+# Optional libjpeg-turbo decoder (SIMD direct-to-RGB, falls back to Pillow)
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    _turbojpeg = TurboJPEG()
+except Exception:
+    _turbojpeg = None
+
+# Optional fast JSON serializer (falls back to stdlib json)
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+# Optional NumPy for zero-copy pixel hashing
+try:
+    import numpy
+except Exception:
+    numpy = None
+
+# Optional BLAKE3 for key-file fingerprinting (falls back to blake2b)
+try:
+    import blake3
+except Exception:
+    blake3 = None
+
+# Optional SIMD base64 codec (falls back to stdlib base64)
+try:
+    import pybase64 as _b64
+except Exception:
+    _b64 = base64
+
 # --------- Cross-platform path fix ----------
 def fix_path(path: str) -> str:
     """Converts Windows backslashes → forward slashes, safe on all OS."""
@@ -51,10 +89,28 @@ FINAL_IMAGE_PATH = fix_path("capture_with_proof.jpg")
 
 
 # --------- Key management ----------
+def _pem_fingerprint(pem: bytes) -> bytes:
+    if blake3 is not None:
+        return blake3.blake3(pem).digest()
+    return hashlib.blake2b(pem, digest_size=32).digest()
+
+
+_privkey_cache = {}  # PEM fingerprint -> parsed private key
+
+
 def ensure_private_key():
     if os.path.exists(PRIVATE_KEY_PATH):
         with open(PRIVATE_KEY_PATH, "rb") as f:
-            return serialization.load_pem_private_key(f.read(), password=None)
+            pem = f.read()
+        # Skip the ASN.1 parse when the PEM hasn't changed since the
+        # last call (fingerprint catches on-disk key rotation).
+        fp = _pem_fingerprint(pem)
+        key = _privkey_cache.get(fp)
+        if key is None:
+            key = serialization.load_pem_private_key(pem, password=None)
+            _privkey_cache.clear()
+            _privkey_cache[fp] = key
+        return key
 
     key = ed25519.Ed25519PrivateKey.generate()
     pem = key.private_bytes(
@@ -66,6 +122,7 @@ def ensure_private_key():
         f.write(pem)
     os.chmod(PRIVATE_KEY_PATH, 0o600)
     print("[+] Generated private key")
+    _privkey_cache[_pem_fingerprint(pem)] = key
     return key
 
 
@@ -106,7 +163,7 @@ def capture_photo(output_path):
         picam.capture_file(output_path)
         picam.stop()
         print(f"[+] Captured via Picamera2 -> {output_path}")
-        return
+        return True
 
     # ---------------------
     # 2. macOS Support
@@ -119,7 +176,7 @@ def capture_photo(output_path):
                 print("[+] Capturing using imagesnap...")
                 subprocess.run(["imagesnap", output_path], check=True)
                 print(f"[+] Captured using imagesnap -> {output_path}")
-                return
+                return True
             except subprocess.CalledProcessError as e:
                 print("[!] imagesnap failed:", e)
 
@@ -145,7 +202,7 @@ def capture_photo(output_path):
                 ], check=True)
 
                 print(f"[+] Captured using ffmpeg -> {output_path}")
-                return
+                return True
 
             except Exception as e:
                 print("[!] ffmpeg capture failed:", e)
@@ -155,93 +212,297 @@ def capture_photo(output_path):
         print("    brew install imagesnap")
         print("    OR:")
         print("    brew install ffmpeg")
-        return
+        return False
 
     # ---------------------
     # 3. Other platforms
     # ---------------------
     print("[!] No supported camera backend for this OS.")
+    return False
 
 
 # --------- Image hashing (EXIF-safe) ----------
-def strip_exif_and_hash(image_path):
+def _sha256():
+    """SHA-256 instance, using the SHA-NI backend when installed."""
+    if _isal_sha256 is not None:
+        return _isal_sha256()
+    return hashlib.sha256()
+
+
+# Preferred algorithm for new proofs; verification follows whatever
+# algorithm the proof declares in its hash_alg field.
+IMAGE_HASH_ALG = "blake3" if blake3 is not None else "sha256"
+
+
+def _image_hasher(alg=None):
+    alg = alg or IMAGE_HASH_ALG
+    if alg == "blake3":
+        if blake3 is None:
+            raise ValueError("proof uses blake3 but the blake3 module is not installed")
+        return blake3.blake3()
+    if alg == "sha256":
+        return _sha256()
+    raise ValueError(f"unsupported hash_alg: {alg!r}")
+
+
+HASH_TILE_ROWS = 64  # rows per stripe fed to the hasher
+
+
+def _jpeg_scan_range(data):
+    """
+    Locate the image-defining bytes of a JPEG: returns (start, end)
+    offsets from the first non-metadata segment (DQT/DHT/SOF/...)
+    through EOI, or None if the stream is not a well-formed JPEG.
+    Only APPn and COM segments before that point are excluded, so the
+    digest survives EXIF embedding but any change to quantization or
+    Huffman tables, the frame header or the scan data breaks it.
+    """
+    if len(data) < 4 or data[:2] != b"\xff\xd8":
+        return None
+    pos = 2
+    start = None
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if start is None and not (0xE0 <= marker <= 0xEF or marker == 0xFE):
+            start = pos  # first segment that isn't APPn/COM
+        if marker == 0xDA:  # SOS — scan data runs from here to EOI
+            end = data.rfind(b"\xff\xd9")
+            if end <= pos:
+                return None
+            return start, end + 2
+        if 0xD0 <= marker <= 0xD9 or marker == 0x01:
+            pos += 2
+            continue
+        pos += 2 + int.from_bytes(data[pos + 2:pos + 4], "big")
+    return None
+
+
+def _map_file(path):
+    """
+    mmap a file read-only with sequential-access readahead hints;
+    returns (buffer, owns_map). Falls back to a plain read() for files
+    that cannot be mapped (empty files, exotic filesystems).
+    """
+    with open(path, "rb") as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            return f.read(), False
+    if hasattr(data, "madvise"):
+        # One streaming pass: tell the kernel to read ahead
+        # aggressively and drop pages behind us.
+        data.madvise(mmap.MADV_SEQUENTIAL)
+    return data, True
+
+
+# Scheme tag for proofs hashed over JPEG segments instead of pixels,
+# appended to the base algorithm (e.g. "blake3-jpeg-scan").
+_JPEG_SCAN_SUFFIX = "-jpeg-scan"
+
+
+def _scan_digest(hsh, image_path, data=None):
+    """
+    Digest of the JPEG's image-defining segments (tables, frame
+    header, scan data), or None if the markers do not parse. EXIF
+    lives in APPn segments excluded from the range, so the digest
+    survives metadata embedding without any decode.
+    """
+    owns_map = False
+    if data is None:
+        # mmap instead of read(): the kernel pages bytes in as the
+        # hasher streams through them, no heap copy of the whole file.
+        data, owns_map = _map_file(image_path)
+    try:
+        scan = _jpeg_scan_range(data)
+        if scan is None:
+            return None
+        start, end = scan
+        hsh.update(memoryview(data)[start:end])
+        return hsh.hexdigest()
+    finally:
+        if owns_map:
+            data.close()
+
+
+def _pixel_digest(hsh, image_path, data=None):
+    """Digest of "WxH" plus the decoded RGB pixels."""
+    if _turbojpeg is not None and image_path.lower().endswith((".jpg", ".jpeg")):
+        try:
+            if data is None:
+                with open(image_path, "rb") as f:
+                    data = f.read()
+            rgb = _turbojpeg.decode(data, pixel_format=TJPF_RGB)
+            h, w = rgb.shape[:2]
+            hsh.update(f"{w}x{h}".encode())
+            for y in range(0, h, HASH_TILE_ROWS):
+                # row slices are C-contiguous: hashed zero-copy
+                hsh.update(rgb[y:y + HASH_TILE_ROWS])
+            return hsh.hexdigest()
+        except Exception as e:
+            print("[!] TurboJPEG decode failed, falling back to Pillow:", e)
+
     with Image.open(image_path) as img:
-        img_rgb = img.convert("RGB")
+        # convert("RGB") copies the whole image even when it is
+        # already RGB — only pay for it on other modes.
+        img_rgb = img if img.mode == "RGB" else img.convert("RGB")
         w, h = img_rgb.size
-        pixel_data = img_rgb.tobytes()
-
-    hsh = hashlib.sha256()
-    hsh.update(f"{w}x{h}".encode())
-    hsh.update(pixel_data)
+        hsh.update(f"{w}x{h}".encode())
+        # Stream row stripes instead of materializing the full w*h*3 buffer
+        if numpy is not None:
+            arr = numpy.asarray(img_rgb)
+            for y in range(0, h, HASH_TILE_ROWS):
+                # row slices are C-contiguous: hashed zero-copy
+                hsh.update(arr[y:y + HASH_TILE_ROWS])
+        else:
+            for y in range(0, h, HASH_TILE_ROWS):
+                stripe = img_rgb.crop((0, y, w, min(y + HASH_TILE_ROWS, h)))
+                hsh.update(stripe.tobytes())
     return hsh.hexdigest()
 
 
+def strip_exif_and_hash(image_path, data=None, alg=None):
+    """
+    Recompute the image hash for scheme `alg`, as declared in a
+    proof's hash_alg field. Plain "sha256"/"blake3" — and None, i.e.
+    proofs predating the field — hash dimensions + decoded RGB pixels;
+    a "-jpeg-scan" suffix hashes the JPEG's image-defining segments
+    without decoding. Pass data= to reuse already-read bytes.
+    """
+    alg = alg or "sha256"
+    if alg.endswith(_JPEG_SCAN_SUFFIX):
+        hsh = _image_hasher(alg[:-len(_JPEG_SCAN_SUFFIX)])
+        digest = _scan_digest(hsh, image_path, data)
+        if digest is None:
+            raise ValueError(f"proof declares {alg} but the JPEG markers do not parse")
+        return digest
+    return _pixel_digest(_image_hasher(alg), image_path, data)
+
+
+def hash_image_for_proof(image_path, data=None):
+    """
+    Hash an image for a new proof, choosing the best scheme: the
+    decode-free JPEG scan-range hash when the markers parse, decoded
+    pixels otherwise. Returns (hexdigest, hash_alg) so the scheme can
+    be recorded in the proof for verifiers.
+    """
+    if image_path.lower().endswith((".jpg", ".jpeg")):
+        digest = _scan_digest(_image_hasher(), image_path, data)
+        if digest is not None:
+            return digest, IMAGE_HASH_ALG + _JPEG_SCAN_SUFFIX
+    return _pixel_digest(_image_hasher(), image_path, data), IMAGE_HASH_ALG
+
+
 # --------- Canonical JSON payload ----------
 def canonical_payload(d: dict) -> bytes:
+    # The canonical form is the stdlib's: compact separators, sorted
+    # keys, ensure_ascii escapes. orjson emits raw UTF-8 instead of
+    # \uXXXX escapes, so it is only safe when every string is ASCII —
+    # otherwise two installs would sign/verify different bytes.
+    if orjson is not None and all(
+        k.isascii() and (not isinstance(v, str) or v.isascii())
+        for k, v in d.items()
+    ):
+        return orjson.dumps(d, option=orjson.OPT_SORT_KEYS)
     return json.dumps(d, separators=(",", ":"), sort_keys=True).encode()
 
 
 # --------- Signing ----------
-def create_and_sign_proof(privkey, device_id, image_hash, firmware, raw_pub):
+_static_proof_fields = {}  # (device_id, firmware, raw_pub) -> constant proof fields
+
+
+def create_and_sign_proof(privkey, device_id, image_hash, firmware, raw_pub,
+                          hash_alg=None):
+    # The capture-independent half of the proof never changes for a
+    # device, so it is prepared once ahead of time; only timestamp,
+    # hash and nonce are produced per capture. (Ed25519 offers no true
+    # offline/online split — the signature itself must cover the hash.)
+    static = _static_proof_fields.get((device_id, firmware, raw_pub))
+    if static is None:
+        static = _static_proof_fields[(device_id, firmware, raw_pub)] = {
+            "device_id": device_id,
+            "firmware": firmware,
+            "sig_alg": "Ed25519",
+            "public_key_b64": _b64.b64encode(raw_pub).decode(),
+        }
+
     timestamp = datetime.now(timezone.utc).isoformat(timespec="seconds").replace("+00:00", "Z")
-    nonce = secrets.token_hex(16)
+    nonce = os.urandom(16).hex()  # same CSPRNG as secrets.token_hex, fewer layers
 
     proof = {
-        "device_id": device_id,
+        "device_id": static["device_id"],
         "timestamp": timestamp,
         "image_hash": image_hash,
+        "hash_alg": hash_alg or IMAGE_HASH_ALG,
         "nonce": nonce,
-        "firmware": firmware,
-        "sig_alg": "Ed25519",
-        "public_key_b64": base64.b64encode(raw_pub).decode()
+        "firmware": static["firmware"],
+        "sig_alg": static["sig_alg"],
+        "public_key_b64": static["public_key_b64"],
     }
 
     msg = canonical_payload(proof)
     signature = privkey.sign(msg)
 
-    proof["signature"] = base64.b64encode(signature).decode()
+    proof["signature"] = _b64.b64encode(signature).decode()
     return proof
 
 
 # --------- EXIF embed ----------
-def embed_proof_into_exif(input_image_path: str, proof: dict, output_image_path: str):
+# Fresh captures carry no EXIF worth preserving — start from this
+# template instead of round-tripping the file through piexif.load.
+_EXIF_TEMPLATE = {"0th": {}, "Exif": {}, "GPS": {}, "1st": {}, "thumbnail": None}
+
+
+def _fresh_exif_dict():
+    return {k: dict(v) if isinstance(v, dict) else v for k, v in _EXIF_TEMPLATE.items()}
+
+
+def embed_proof_into_exif(input_image_path: str, proof: dict, output_image_path: str,
+                          fresh_capture: bool = False, jpeg_bytes: bytes = None):
     """
-    Cross-platform EXIF writer:
-    - macOS: Always uses 3-argument piexif.insert(...)
-    - Linux: Tries binary insert then falls back
-    - Windows: Uses 3-arg insert
+    Cross-platform EXIF writer.
+
+    Reads the input JPEG once (or reuses jpeg_bytes if the caller
+    already has them) and does a binary piexif.insert on those bytes;
+    falls back to the 3-argument insert and finally a Pillow re-encode
+    if piexif rejects the stream. Pass fresh_capture=True for images
+    straight off the sensor to skip the piexif.load parse.
     """
     proof_json = json.dumps(proof, separators=(',', ':'))
-    
-    try:
-        exif_dict = piexif.load(input_image_path)
-    except Exception:
-        exif_dict = {"0th": {}, "Exif": {}, "GPS": {}, "1st": {}, "thumbnail": None}
+
+    if jpeg_bytes is None:
+        with open(input_image_path, "rb") as f:
+            jpeg_bytes = f.read()
+
+    if fresh_capture:
+        exif_dict = _fresh_exif_dict()
+    else:
+        try:
+            exif_dict = piexif.load(jpeg_bytes)
+        except Exception:
+            exif_dict = _fresh_exif_dict()
 
     exif_dict.setdefault("Exif", {})
     exif_dict["Exif"][piexif.ExifIFD.UserComment] = proof_json.encode("utf-8")
 
     exif_bytes = piexif.dump(exif_dict)
 
-    # ---- macOS & Windows: use the safe 3-arg insert() ----
+    # ---- Binary insert on the already-read bytes ----
     try:
-        piexif.insert(exif_bytes, input_image_path, output_image_path)
-        print(f"[+] Embedded proof using piexif 3-arg insert -> {output_image_path}")
+        piexif.insert(exif_bytes, jpeg_bytes, output_image_path)
+        print(f"[+] Embedded proof using binary mode -> {output_image_path}")
         return
     except Exception as e:
-        print("[!] 3-argument insert failed:", e)
+        print("[!] Binary insert failed:", e)
 
-    # ---- Linux fallback: binary insert ----
+    # ---- Fallback: let piexif re-read the file itself ----
     try:
-        with open(input_image_path, "rb") as f:
-            jpeg_bytes = f.read()
-        new_jpeg = piexif.insert(exif_bytes, jpeg_bytes)
-        with open(output_image_path, "wb") as f:
-            f.write(new_jpeg)
-        print(f"[+] Embedded proof using binary mode -> {output_image_path}")
+        piexif.insert(exif_bytes, input_image_path, output_image_path)
+        print(f"[+] Embedded proof using piexif 3-arg insert -> {output_image_path}")
         return
     except Exception as e:
-        print("[!] Binary insert failed:", e)
+        print("[!] 3-argument insert failed:", e)
 
     # ---- Last fallback (lossy): Pillow re-encode ----
     from PIL import Image
@@ -252,21 +513,36 @@ def embed_proof_into_exif(input_image_path: str, proof: dict, output_image_path:
 
 # --------- Verify ----------
 def verify_embedded_proof(image_path):
-    exif_dict = piexif.load(image_path)
-    raw = exif_dict["Exif"].get(piexif.ExifIFD.UserComment, b"")
-    proof = json.loads(raw.decode())
+    # One mapped read serves both the EXIF parse and the hash
+    # recompute. For JPEGs the scan-range digest covers these same
+    # file bytes, so verification never decodes a pixel.
+    data, owns_map = _map_file(image_path)
+    try:
+        exif_dict = piexif.load(data)  # piexif slices the buffer; mmap works as-is
+        raw = exif_dict["Exif"].get(piexif.ExifIFD.UserComment, b"")
+        proof = json.loads(raw.decode())
+
+        # Check hash (older proofs without hash_alg were SHA-256).
+        # Fail closed if the declared scheme can't be recomputed here.
+        try:
+            recomputed = strip_exif_and_hash(image_path, data=data,
+                                             alg=proof.get("hash_alg", "sha256"))
+        except ValueError as e:
+            print("❌ Cannot recompute image hash:", e)
+            return False
+    finally:
+        if owns_map:
+            data.close()
 
-    # Check hash
-    recomputed = strip_exif_and_hash(image_path)
     if recomputed != proof["image_hash"]:
         print("❌ HASH MISMATCH — image altered!")
         return False
 
-    # Verify signature
-    pub_raw = base64.b64decode(proof["public_key_b64"])
-    signature = base64.b64decode(proof["signature"])
-    payload = {k: proof[k] for k in proof if k != "signature"}
-    msg = canonical_payload(payload)
+    # Verify signature. Popping the signature restores exactly the
+    # dict that was signed — no need to rebuild a filtered copy.
+    pub_raw = _b64.b64decode(proof["public_key_b64"])
+    signature = _b64.b64decode(proof.pop("signature"))
+    msg = canonical_payload(proof)
 
     pub = ed25519.Ed25519PublicKey.from_public_bytes(pub_raw)
 
@@ -279,24 +555,85 @@ def verify_embedded_proof(image_path):
         return False
 
 
+def verify_embedded_proofs_batch(image_paths):
+    """
+    Verify many captures at once. Image hashes are recomputed in a
+    thread pool first (hashlib releases the GIL while digesting, so
+    hashing runs on all cores), then each signature is checked.
+    Returns {path: bool}.
+    """
+    results = {}
+
+    # Phase 1: parallel preflight — EXIF parse and hash recompute per
+    # file in one pooled task, so file I/O and digesting overlap
+    # across captures.
+    def _preflight(path):
+        exif_dict = piexif.load(path)
+        raw = exif_dict["Exif"].get(piexif.ExifIFD.UserComment, b"")
+        proof = json.loads(raw.decode())
+        return proof, strip_exif_and_hash(path, alg=proof.get("hash_alg", "sha256"))
+
+    workers = min(len(image_paths), os.cpu_count() or 1) or 1
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [(path, pool.submit(_preflight, path)) for path in image_paths]
+
+    sigs, msgs, pubs, batch_paths = [], [], [], []
+    for path, fut in futures:
+        try:
+            proof, digest = fut.result()
+        except Exception as e:
+            print(f"❌ {path}: {e}")
+            results[path] = False
+            continue
+        if digest != proof["image_hash"]:
+            print(f"❌ {path}: hash mismatch — image altered!")
+            results[path] = False
+            continue
+        try:
+            sigs.append(_b64.b64decode(proof.pop("signature")))
+            pubs.append(_b64.b64decode(proof["public_key_b64"]))
+            msgs.append(canonical_payload(proof))
+            batch_paths.append(path)
+        except Exception as e:
+            print(f"❌ {path}: {e}")
+            results[path] = False
+
+    # Phase 2: signature check.
+    for path, sig, msg, pub_raw in zip(batch_paths, sigs, msgs, pubs):
+        pub = ed25519.Ed25519PublicKey.from_public_bytes(pub_raw)
+        try:
+            pub.verify(sig, msg)
+            results[path] = True
+        except Exception:
+            print(f"❌ {path}: signature invalid")
+            results[path] = False
+    return results
+
+
 # --------- MAIN FLOW ----------
 def main():
     priv = ensure_private_key()
     pem, raw_pub = export_public_key(priv)
 
+    captured = False
     try:
-        capture_photo(RAW_IMAGE_PATH)
+        captured = bool(capture_photo(RAW_IMAGE_PATH))
     except Exception as e:
         print("[!] Camera capture failed:", e)
 
     if not os.path.exists(RAW_IMAGE_PATH):
         sys.exit("❌ Missing input image at: " + RAW_IMAGE_PATH)
 
-    image_hash = strip_exif_and_hash(RAW_IMAGE_PATH)
-    print("[+] Image hash:", image_hash)
+    # One read serves both the hash and the EXIF embed.
+    with open(RAW_IMAGE_PATH, "rb") as f:
+        raw_bytes = f.read()
+
+    image_hash, hash_alg = hash_image_for_proof(RAW_IMAGE_PATH, data=raw_bytes)
+    print(f"[+] Image hash ({hash_alg}):", image_hash)
 
-    proof = create_and_sign_proof(priv, DEVICE_ID, image_hash, FIRMWARE, raw_pub)
-    embed_proof_into_exif(RAW_IMAGE_PATH, proof, FINAL_IMAGE_PATH)
+    proof = create_and_sign_proof(priv, DEVICE_ID, image_hash, FIRMWARE, raw_pub, hash_alg)
+    embed_proof_into_exif(RAW_IMAGE_PATH, proof, FINAL_IMAGE_PATH,
+                          fresh_capture=captured, jpeg_bytes=raw_bytes)
 
     print("\nVerifying...")
     ok = verify_embedded_proof(FINAL_IMAGE_PATH)